@@ -1,5 +1,11 @@
+import re
+import time
+import collections
+import select
 import socket
+import struct
 import errno
+import threading
 
 
 class FtpClient(object):
@@ -11,6 +17,14 @@ class FtpClient(object):
                 None otherwise.
     user (str): The username of the logged in user, if logged in, None
                 otherwise.
+    block_mode (bool): Whether transfers use block mode (MODE B), which keeps
+                       a single data connection open across transfers.
+    restart_marker (str): Last restart marker received from the host in
+                          block mode, if any, None otherwise.
+    transfer_stats (dict): Cumulative bytes transferred over data
+                           connections and seconds spent waiting on the
+                           network, on local disk IO and on data connection
+                           setup.
     """
 
     class ConnectionRefusedException(socket.error):
@@ -58,6 +72,22 @@ class FtpClient(object):
             self.msg = 'Connection to {}:{} timed out'.format(host,
                                                               FtpClient.PORT)
 
+    class DataConnectionClosedException(socket.error):
+        """
+        Exception raised when an FTP host closes the data connection in the
+        middle of a block mode transfer.
+
+        Args:
+        host (str): Host that closed the data connection.
+
+        Attributes:
+        msg (str): Human readable string describing the exception.
+        """
+        def __init__(self, host):
+            super(FtpClient.DataConnectionClosedException, self).__init__()
+            self.msg = 'Data connection to {} closed before the transfer ' \
+                'completed.'.format(host)
+
     class NotConnectedException(Exception):
         """
         Exception raised when FTP commands are performed but the client
@@ -82,6 +112,34 @@ class FtpClient(object):
             super(FtpClient.NotAuthenticatedException, self).__init__()
             self.msg = 'Not authenticated.'
 
+    class TransferModeMismatchException(Exception):
+        """
+        Exception raised when a transfer between two FTP hosts is attempted
+        while their clients use different transfer modes.
+
+        Attributes:
+        msg (str): Human readable string describing the exception.
+        """
+        def __init__(self):
+            super(FtpClient.TransferModeMismatchException, self).__init__()
+            self.msg = 'Both hosts must use the same transfer mode.'
+
+    class LaggingHostException(Exception):
+        """
+        Exception raised when an FTP host falls too far behind the other
+        hosts of a fan-out upload and is dropped from it.
+
+        Args:
+        window (int): Number of chunks the host fell behind.
+
+        Attributes:
+        msg (str): Human readable string describing the exception.
+        """
+        def __init__(self, window):
+            super(FtpClient.LaggingHostException, self).__init__()
+            self.msg = 'Fell more than {} chunks behind the other hosts.'\
+                .format(window)
+
     class LocalIOException(IOError):
         """
         Exception raised when something goes wrong during local IO operations.
@@ -96,6 +154,17 @@ class FtpClient(object):
     PORT = 21
     SOCKET_TIMEOUT_SECONDS = 5
     SOCKET_RCV_BYTES = 4096
+    STORE_CHUNK_BYTES = 65536
+    FAN_OUT_WINDOW_CHUNKS = 16
+
+    BLOCK_HEADER_FORMAT = '>BH'
+    BLOCK_HEADER_BYTES = struct.calcsize(BLOCK_HEADER_FORMAT)
+    BLOCK_MAX_BYTES = 65535
+    BLOCK_DESCRIPTOR_EOF = 64
+    BLOCK_DESCRIPTOR_RESTART_MARKER = 16
+
+    MODE_BLOCK = 'B'
+    MODE_STREAM = 'S'
 
     LIST_COMMAND = 'LIST'
     USER_COMMAND = 'USER'
@@ -112,24 +181,41 @@ class FtpClient(object):
     RMD_COMMAND = 'RMD'
     RNFR_COMMAND = 'RNFR'
     RNTO_COMMAND = 'RNTO'
-
+    MODE_COMMAND = 'MODE'
+    PASV_COMMAND = 'PASV'
+    PORT_COMMAND = 'PORT'
+    ABOR_COMMAND = 'ABOR'
+
+    STATUS_PRELIMINARY = '1'
+    STATUS_COMPLETION = '2'
+    STATUS_200 = '200'
+    STATUS_227 = '227'
     STATUS_230 = '230'
     STATUS_550 = '550'
     STATUS_530 = '530'
+    STATUS_426 = '426'
 
     def __init__(self, debug=False):
         self._debug = debug
+        self.transfer_stats = {'bytes': 0, 'network_seconds': 0.0,
+                               'disk_seconds': 0.0,
+                               'data_connection_seconds': 0.0}
         self._reset_sockets()
 
     def _log(self, info):
         if self._debug:
             print('debug: {}'.format(info))
 
+    def _add_transfer_seconds(self, stat, start):
+        self.transfer_stats[stat] += time.time() - start
+
     def _reset_sockets(self):
         self._reset_command_socket()
         self._reset_data_socket()
         self.host = None
         self.user = None
+        self.block_mode = False
+        self.restart_marker = None
 
     def _reset_command_socket(self):
         if getattr(self, 'host', None) is not None:
@@ -138,9 +224,11 @@ class FtpClient(object):
         self._command_socket.settimeout(FtpClient.SOCKET_TIMEOUT_SECONDS)
 
     def _reset_data_socket(self):
+        self._close_data_connection()
         if getattr(self, '_data_socket_listening', False):
             self._data_socket.close()
         self._data_socket = socket.socket()
+        self._data_socket.settimeout(FtpClient.SOCKET_TIMEOUT_SECONDS)
         self._data_socket_listening = False
 
     def _send_command(self, command, *args):
@@ -152,8 +240,13 @@ class FtpClient(object):
         except socket.timeout:
             raise FtpClient.TimeoutException(self.host)
 
-    def _receive_command_data(self):
-        data = self._command_socket.recv(FtpClient.SOCKET_RCV_BYTES)
+    def _receive_command_data(self, stat='network_seconds'):
+        start = time.time()
+        try:
+            data = self._command_socket.recv(FtpClient.SOCKET_RCV_BYTES)
+        except socket.timeout:
+            raise FtpClient.TimeoutException(self.host)
+        self._add_transfer_seconds(stat, start)
         self._log('received command data - {}'.format(data))
         return data
 
@@ -166,38 +259,220 @@ class FtpClient(object):
             raise FtpClient.NotAuthenticatedException()
 
     def _open_data_socket(self):
-        self._data_address, self._data_port = \
-            self._command_socket.getsockname()
-        self._data_port = self._data_port + 1
-        self._data_socket.bind(('', self._data_port))
+        self._data_address = self._command_socket.getsockname()[0]
+        self._data_socket.bind(('', 0))
+        self._data_port = self._data_socket.getsockname()[1]
         self._data_socket.listen(1)
         self._data_socket_listening = True
 
     def _open_data_connection(self):
+        if getattr(self, '_data_connection_open', False):
+            if self.block_mode and self._is_data_connection_alive():
+                self._log('reusing data connection')
+                return ''
+            self._close_data_connection()
+        start = time.time()
         if not self._data_socket_listening:
             self._open_data_socket()
         self._send_command(FtpClient.EPRT_COMMAND, '|1|{}|{}|'
                            .format(self._data_address, self._data_port))
-        self._data_connection, address = self._data_socket.accept()
+        try:
+            self._data_connection, address = self._data_socket.accept()
+        except socket.timeout:
+            raise FtpClient.TimeoutException(self.host)
+        self._data_connection.settimeout(FtpClient.SOCKET_TIMEOUT_SECONDS)
+        self._data_connection_open = True
         self._log('opened data connection on {}'.format(address))
-        data = self._receive_command_data()
-        return data
+        self._add_transfer_seconds('data_connection_seconds', start)
+        # The EPRT reply counts as setup, not as network wait.
+        return self._receive_command_data('data_connection_seconds')
+
+    def _is_data_connection_alive(self):
+        # Between block mode transfers the host has nothing to send, so a
+        # readable connection means it was closed (or is out of sync).
+        readable, _, _ = select.select([self._data_connection], [], [], 0)
+        return not readable
+
+    def _close_data_connection(self):
+        if getattr(self, '_data_connection_open', False):
+            self._data_connection.close()
+            self._log('closed data connection')
+        self._data_connection_open = False
 
     def _read_from_data_connection(self):
+        start = time.time()
+        if self.block_mode:
+            try:
+                total_data = self._read_blocks_from_data_connection()
+            except FtpClient.DataConnectionClosedException as e:
+                # The host replies on the control connection about the
+                # failed transfer, read it to keep replies in sync.
+                try:
+                    e.msg = '{}\n{}'.format(e.msg,
+                                            self._receive_command_data())
+                except FtpClient.TimeoutException:
+                    pass
+                raise
+            except socket.timeout:
+                self._close_data_connection()
+                raise FtpClient.TimeoutException(self.host)
+        else:
+            try:
+                total_data = self._read_stream_from_data_connection()
+            except socket.timeout:
+                self._close_data_connection()
+                raise FtpClient.TimeoutException(self.host)
+        self._add_transfer_seconds('network_seconds', start)
+        self.transfer_stats['bytes'] += len(total_data)
+        self._log('received data - {}'.format(total_data))
+        return total_data
+
+    def _read_stream_from_data_connection(self):
         total_data = ''
         while True:
             data = self._data_connection.recv(FtpClient.SOCKET_RCV_BYTES)
             total_data = total_data + data
             if not data:
                 break
-        self._data_connection.close()
-        self._log('received data - {}'.format(total_data))
+        self._close_data_connection()
         return total_data
 
-    def _write_to_data_connection(self, content):
-        self._log('sending data - {}'.format(content))
-        self._data_connection.sendall(content)
-        self._data_connection.close()
+    def _receive_exactly_from_data_connection(self, size):
+        total_data = ''
+        while len(total_data) < size:
+            data = self._data_connection.recv(size - len(total_data))
+            if not data:
+                return None
+            total_data = total_data + data
+        return total_data
+
+    def _read_blocks_from_data_connection(self):
+        total_data = ''
+        while True:
+            header = self._receive_exactly_from_data_connection(
+                FtpClient.BLOCK_HEADER_BYTES)
+            data = None
+            if header is not None:
+                descriptor, count = struct.unpack(
+                    FtpClient.BLOCK_HEADER_FORMAT, header)
+                data = self._receive_exactly_from_data_connection(count)
+            if data is None:
+                # No EOF block, the transfer is incomplete.
+                self._close_data_connection()
+                raise FtpClient.DataConnectionClosedException(self.host)
+            if descriptor & FtpClient.BLOCK_DESCRIPTOR_RESTART_MARKER:
+                self.restart_marker = data
+                self._log('received restart marker - {}'.format(data))
+            else:
+                total_data = total_data + data
+            if descriptor & FtpClient.BLOCK_DESCRIPTOR_EOF:
+                break
+        return total_data
+
+    def _write_blocks_to_data_connection(self, content, eof=True):
+        offset = 0
+        while True:
+            data = content[offset:offset + FtpClient.BLOCK_MAX_BYTES]
+            offset = offset + len(data)
+            descriptor = 0
+            if eof and offset >= len(content):
+                descriptor = FtpClient.BLOCK_DESCRIPTOR_EOF
+            if data or descriptor:
+                header = struct.pack(FtpClient.BLOCK_HEADER_FORMAT,
+                                     descriptor, len(data))
+                self._data_connection.sendall(header + data)
+            if offset >= len(content):
+                break
+
+    def _write_chunks_to_data_connection(self, chunks):
+        for chunk in chunks:
+            self._log('sending data - {}'.format(chunk))
+            start = time.time()
+            try:
+                if self.block_mode:
+                    self._write_blocks_to_data_connection(chunk, eof=False)
+                else:
+                    self._data_connection.sendall(chunk)
+            except socket.timeout:
+                raise FtpClient.TimeoutException(self.host)
+            except socket.error:
+                raise FtpClient.DataConnectionClosedException(self.host)
+            self._add_transfer_seconds('network_seconds', start)
+            self.transfer_stats['bytes'] += len(chunk)
+        if self.block_mode:
+            self._write_blocks_to_data_connection('')
+        else:
+            self._close_data_connection()
+
+    def _store_chunks(self, chunks, filename):
+        data = self._open_data_connection()
+
+        self._send_command(FtpClient.STOR_COMMAND, filename)
+        stor_data = self._receive_command_data()
+        data = data + stor_data
+        if not stor_data.startswith(FtpClient.STATUS_PRELIMINARY):
+            return data, False
+
+        try:
+            self._write_chunks_to_data_connection(chunks)
+        except (FtpClient.TimeoutException,
+                FtpClient.DataConnectionClosedException,
+                FtpClient.LaggingHostException,
+                FtpClient.LocalIOException) as e:
+            # Closing a stream mode data connection would make the host
+            # keep the partial file, abort the transfer before closing it.
+            data = data + self._abort_transfer()
+            self._close_data_connection()
+            self._send_command(FtpClient.DELE_COMMAND, filename)
+            data = data + self._receive_command_data()
+            e.msg = '{}\n{}'.format(e.msg, data)
+            raise
+
+        stored_data = self._receive_command_data()
+        data = data + stored_data
+
+        return data, stored_data.startswith(FtpClient.STATUS_COMPLETION)
+
+    @staticmethod
+    def _fan_out_store_worker(ftp_client, chunks, consumer, filename,
+                              result):
+        start = time.time()
+        try:
+            ftp_client._check_is_connected()
+            ftp_client._check_is_authenticated()
+            result['message'], result['succeeded'] = \
+                ftp_client._store_chunks(chunks.chunks(consumer), filename)
+        except (FtpClient.TimeoutException,
+                FtpClient.DataConnectionClosedException,
+                FtpClient.NotConnectedException,
+                FtpClient.NotAuthenticatedException,
+                FtpClient.LaggingHostException,
+                FtpClient.LocalIOException) as e:
+            result['message'] = e.msg
+        except socket.error as e:
+            result['message'] = str(e)
+        finally:
+            chunks.remove_consumer(consumer)
+        result['seconds'] = time.time() - start
+
+    def _passive(self):
+        self._send_command(FtpClient.PASV_COMMAND)
+        data = self._receive_command_data()
+        address = None
+        if data.startswith(FtpClient.STATUS_227):
+            match = re.search(r'(\d+,\d+,\d+,\d+,\d+,\d+)', data)
+            if match is not None:
+                address = match.group(1)
+        return data, address
+
+    def _abort_transfer(self):
+        self._send_command(FtpClient.ABOR_COMMAND)
+        data = self._receive_command_data()
+        # An aborted transfer gets a 426 reply followed by the ABOR reply.
+        if data.startswith(FtpClient.STATUS_426) and \
+                '\n{}'.format(FtpClient.STATUS_COMPLETION) not in data:
+            data = data + self._receive_command_data()
+        return data
 
     def connect(self, host=None):
         """
@@ -257,6 +532,37 @@ class FtpClient(object):
 
         return data
 
+    def mode(self, block=True):
+        """
+        Perform MODE command on connected host. Block mode keeps a single
+        data connection open and reuses it for consecutive transfers. If the
+        host does not support block mode, the client stays in stream mode.
+
+        Args:
+            block (bool): Whether to switch to block mode (MODE B) or back to
+                          stream mode (MODE S). (Optional)
+
+        Returns:
+            Message from host.
+        """
+        self._check_is_connected()
+        self._check_is_authenticated()
+
+        if block:
+            self._send_command(FtpClient.MODE_COMMAND, FtpClient.MODE_BLOCK)
+        else:
+            self._send_command(FtpClient.MODE_COMMAND, FtpClient.MODE_STREAM)
+        data = self._receive_command_data()
+
+        if data.startswith(FtpClient.STATUS_200) and block != self.block_mode:
+            # Data connections can't be carried over between modes.
+            self._close_data_connection()
+            self.block_mode = block
+        self._log('using {} mode'.format('block' if self.block_mode
+                                         else 'stream'))
+
+        return data
+
     def logout(self):
         """
         Clear info about currently logged user on connected host.
@@ -336,12 +642,14 @@ class FtpClient(object):
         if not retr_data.startswith(FtpClient.STATUS_550):
             content = self._read_from_data_connection()
 
+            start = time.time()
             try:
                 local_file = open(local_filename, 'w+')
                 local_file.write(content)
                 local_file.close()
             except IOError as e:
                 raise FtpClient.LocalIOException(e.strerror)
+            self._add_transfer_seconds('disk_seconds', start)
 
             data = data + self._receive_command_data()
 
@@ -361,21 +669,158 @@ class FtpClient(object):
         self._check_is_connected()
         self._check_is_authenticated()
 
-        data = self._open_data_connection()
-
+        start = time.time()
         try:
             local_file = open(local_filename, 'r')
-            self._send_command(FtpClient.STOR_COMMAND, filename)
-            data = data + self._receive_command_data()
-            self._write_to_data_connection(local_file.read())
+            content = local_file.read()
             local_file.close()
         except IOError as e:
             raise FtpClient.LocalIOException(e.strerror)
+        self._add_transfer_seconds('disk_seconds', start)
+
+        data, _ = self._store_chunks([content], filename)
 
-        data = data + self._receive_command_data()
+        return data
+
+    def copy_to(self, target, filename, target_filename=None):
+        """
+        Copy a file from the connected host to the host `target` is connected
+        to (FXP). The connected host is put in passive mode and `target` is
+        pointed at it with PORT, so data flows directly between both hosts.
+        Both clients must use the same transfer mode.
+
+        Raises:
+            TransferModeMismatchException: If the clients use different
+                                           transfer modes.
+
+        Args:
+            target (FtpClient): Client connected to the destination host.
+            filename (str): Name of remote file to copy.
+            target_filename (str): Name of file to create on the destination
+                                   host, defaults to `filename`. (Optional)
+
+        Returns:
+            Messages from both hosts.
+        """
+        self._check_is_connected()
+        self._check_is_authenticated()
+        target._check_is_connected()
+        target._check_is_authenticated()
+        if self.block_mode != target.block_mode:
+            raise FtpClient.TransferModeMismatchException()
+
+        target_filename = target_filename or filename
+
+        # PASV and PORT replace the data connections hosts were using.
+        self._close_data_connection()
+        target._close_data_connection()
+
+        data, address = self._passive()
+        if address is None:
+            return data
+
+        target._send_command(FtpClient.PORT_COMMAND, address)
+        port_data = target._receive_command_data()
+        data = data + port_data
+        if not port_data.startswith(FtpClient.STATUS_200):
+            return data + self._abort_transfer()
+
+        target._send_command(FtpClient.STOR_COMMAND, target_filename)
+        stor_data = target._receive_command_data()
+        data = data + stor_data
+        if not stor_data.startswith(FtpClient.STATUS_PRELIMINARY):
+            # The source host is still listening for a data connection.
+            return data + self._abort_transfer()
+
+        self._send_command(FtpClient.RETR_COMMAND, filename)
+        retr_data = self._receive_command_data()
+        data = data + retr_data
+
+        if not retr_data.startswith(FtpClient.STATUS_PRELIMINARY):
+            # The destination host is still waiting on its data connection.
+            data = data + target._abort_transfer()
+        else:
+            data = data + self._receive_command_data()
+            data = data + target._receive_command_data()
 
         return data
 
+    def copy_all_to(self, target, filenames):
+        """
+        Copy several files from the connected host to the host `target` is
+        connected to (FXP), keeping their names.
+
+        Args:
+            target (FtpClient): Client connected to the destination host.
+            filenames (list): Names of remote files to copy.
+
+        Returns:
+            Messages from both hosts.
+        """
+        data = ''
+        for filename in filenames:
+            data = data + self.copy_to(target, filename)
+        return data
+
+    @staticmethod
+    def fan_out_store(ftp_clients, local_filename, filename):
+        """
+        Perform STOR command on several connected hosts at the same time,
+        reading the local file only once. At most `FAN_OUT_WINDOW_CHUNKS`
+        chunks are kept in memory: reading waits for the slowest host, and a
+        host that stays that far behind for `SOCKET_TIMEOUT_SECONDS` is
+        dropped so it doesn't stall the others.
+
+        Args:
+            ftp_clients (list): Clients connected and authenticated to the
+                                destination hosts.
+            local_filename (str): Name of local file to send.
+            filename (str): Name of remote file to create.
+
+        Returns:
+            A list with one dict per client, in the same order, holding the
+            `host`, whether the upload `succeeded`, the `message` from the
+            host and the elapsed `seconds`.
+        """
+        try:
+            local_file = open(local_filename, 'r')
+        except IOError as e:
+            raise FtpClient.LocalIOException(e.strerror)
+
+        chunks = _ChunkBuffer(FtpClient.FAN_OUT_WINDOW_CHUNKS,
+                              FtpClient.SOCKET_TIMEOUT_SECONDS)
+        results = []
+        workers = []
+        for ftp_client in ftp_clients:
+            result = {'host': ftp_client.host, 'succeeded': False,
+                      'message': '', 'seconds': 0}
+            worker = threading.Thread(target=FtpClient._fan_out_store_worker,
+                                      args=(ftp_client, chunks,
+                                            chunks.add_consumer(), filename,
+                                            result))
+            worker.daemon = True
+            results.append(result)
+            workers.append(worker)
+        for worker in workers:
+            worker.start()
+
+        try:
+            while chunks.has_consumers():
+                chunk = local_file.read(FtpClient.STORE_CHUNK_BYTES)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            chunks.close()
+        except IOError as e:
+            chunks.close(e.strerror or str(e))
+        finally:
+            local_file.close()
+
+        for worker in workers:
+            worker.join()
+
+        return results
+
     def pwd(self):
         """
         Perform PWD command on connected host.
@@ -501,3 +946,103 @@ class FtpClient(object):
             data = data + self._receive_command_data()
 
         return data
+
+
+class _ChunkBuffer(object):
+    """
+    Window of chunks of a local file shared by several uploads. Chunks are
+    freed once every consumer has read them. Appending waits while the
+    slowest consumer is `window` chunks behind, and consumers still that far
+    behind after `timeout` seconds are dropped.
+    """
+    def __init__(self, window, timeout):
+        self._window = window
+        self._timeout = timeout
+        self._chunks = collections.deque()
+        self._first = 0
+        self._positions = {}
+        self._dropped = set()
+        self._next_consumer = 0
+        self._closed = False
+        self._error = None
+        self._condition = threading.Condition()
+
+    def _end(self):
+        return self._first + len(self._chunks)
+
+    def _lagging_consumers(self):
+        return [consumer for consumer, position in self._positions.items()
+                if self._end() - position >= self._window]
+
+    def _free_consumed_chunks(self):
+        oldest = min(self._positions.values()) if self._positions \
+            else self._end()
+        while self._first < oldest:
+            self._chunks.popleft()
+            self._first = self._first + 1
+
+    def add_consumer(self):
+        with self._condition:
+            consumer = self._next_consumer
+            self._next_consumer = self._next_consumer + 1
+            self._positions[consumer] = self._first
+            return consumer
+
+    def remove_consumer(self, consumer):
+        with self._condition:
+            self._positions.pop(consumer, None)
+            self._free_consumed_chunks()
+            self._condition.notify_all()
+
+    def has_consumers(self):
+        with self._condition:
+            return bool(self._positions)
+
+    def append(self, chunk):
+        with self._condition:
+            deadline = time.time() + self._timeout
+            while self._lagging_consumers():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    for consumer in self._lagging_consumers():
+                        del self._positions[consumer]
+                        self._dropped.add(consumer)
+                    self._free_consumed_chunks()
+                    break
+                self._condition.wait(remaining)
+            self._chunks.append(chunk)
+            self._condition.notify_all()
+
+    def close(self, error=None):
+        """
+        Mark the end of the chunks, or a local IO `error` message if the file
+        couldn't be read to the end.
+        """
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def chunks(self, consumer):
+        """
+        Yield every chunk for `consumer`, waiting for new ones until the
+        buffer is closed.
+        """
+        while True:
+            with self._condition:
+                while consumer in self._positions and \
+                        self._positions[consumer] == self._end() and \
+                        not self._closed:
+                    self._condition.wait()
+                if consumer in self._dropped:
+                    raise FtpClient.LaggingHostException(self._window)
+                position = self._positions.get(consumer, self._end())
+                if position == self._end():
+                    if self._error is not None:
+                        raise FtpClient.LocalIOException(self._error)
+                    return
+                chunk = self._chunks[position - self._first]
+                self._positions[consumer] = position + 1
+                self._free_consumed_chunks()
+                self._condition.notify_all()
+            yield chunk
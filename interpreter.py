@@ -1,4 +1,5 @@
 import os
+import time
 from cmd import Cmd
 
 from client import FtpClient
@@ -13,7 +14,10 @@ class FtpInterpreter(Cmd):
         self.intro = ('FTP Client. Start typing help or ? to see available '
                       'commands.')
         self.prompt = 'FTP > '
+        self._debug = debug
         self._ftp_client = FtpClient(debug=debug)
+        self._latencies = {}
+        self._helper_transfer_stats = {}
 
     def _update_prompt(self):
         prompt = 'FTP'
@@ -24,12 +28,24 @@ class FtpInterpreter(Cmd):
         self.prompt = '{} > '.format(prompt)
 
     def _perform_ftp_command(self, command, *args):
-        method = getattr(self._ftp_client, command)
+        start = time.time()
+        response = self._perform_client_command(self._ftp_client, command,
+                                                *args)
+        self._record_latency(command, start)
+        return response
+
+    def _perform_client_command(self, ftp_client, command, *args):
+        return self._call_ftp_method(getattr(ftp_client, command), command,
+                                     *args)
+
+    def _call_ftp_method(self, method, command, *args):
         try:
             response = method(*args)
         except (FtpClient.TimeoutException,
                 FtpClient.UnknownHostException,
-                FtpClient.ConnectionRefusedException) as e:
+                FtpClient.ConnectionRefusedException,
+                FtpClient.DataConnectionClosedException,
+                FtpClient.TransferModeMismatchException) as e:
             response = e.msg
         except FtpClient.NotConnectedException as e:
             response = e.msg
@@ -45,9 +61,50 @@ class FtpInterpreter(Cmd):
                         ' please try again.').format(response, command)
         return response
 
+    def _record_latency(self, command, start):
+        self._latencies.setdefault(command, []).append(time.time() - start)
+
+    def _disconnect_helper_client(self, ftp_client):
+        self._perform_client_command(ftp_client, 'disconnect')
+        for stat, value in ftp_client.transfer_stats.items():
+            self._helper_transfer_stats[stat] = \
+                self._helper_transfer_stats.get(stat, 0) + value
+
+    @staticmethod
+    def _percentile(sorted_values, percent):
+        index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+        return sorted_values[index]
+
     def emptyline(self):
         pass
 
+    def do_stats(self, *args):
+        """
+        Command to show latency percentiles per FTP command, bytes
+        transferred and how time was split between network wait, local disk
+        IO and data connection setup.
+        """
+        print '{:<16}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'command', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+        for command in sorted(self._latencies):
+            latencies = sorted(self._latencies[command])
+            print '{:<16}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>10.1f}'.format(
+                command, len(latencies),
+                self._percentile(latencies, 50) * 1000,
+                self._percentile(latencies, 90) * 1000,
+                self._percentile(latencies, 99) * 1000,
+                latencies[-1] * 1000)
+
+        transfer_stats = dict(self._ftp_client.transfer_stats)
+        for stat, value in self._helper_transfer_stats.items():
+            transfer_stats[stat] += value
+        print 'Bytes transferred: {}'.format(transfer_stats['bytes'])
+        print 'Network wait: {:.3f}s'.format(
+            transfer_stats['network_seconds'])
+        print 'Disk IO: {:.3f}s'.format(transfer_stats['disk_seconds'])
+        print 'Data connection setup: {:.3f}s'.format(
+            transfer_stats['data_connection_seconds'])
+
     def do_connect(self, host):
         """
         Command to connect to an FTP server in the specified host.
@@ -81,6 +138,21 @@ class FtpInterpreter(Cmd):
         self._perform_ftp_command('logout')
         self._update_prompt()
 
+    def do_mode(self, mode):
+        """
+        Command to switch transfer mode on the connected FTP host. Block mode
+        reuses a single data connection for consecutive transfers, falling
+        back to stream mode if the host does not support it.
+
+        Args:
+            mode (str): Either `block` or `stream`, defaults to `block`.
+        """
+        if mode and mode not in ('block', 'stream'):
+            print 'Unknown mode: {}. Use `block` or `stream`.'.format(mode)
+            return
+        response = self._perform_ftp_command('mode', mode != 'stream')
+        print response
+
     def do_list(self, filename):
         """
         Command to perform LIST command on the connected FTP host.
@@ -138,6 +210,98 @@ class FtpInterpreter(Cmd):
                                              filename)
         print response
 
+    def do_copy(self, *args):
+        """
+        Command to copy files from the connected FTP host to another FTP host,
+        with data flowing directly between both hosts. Several remote files
+        can be given separated by spaces.
+        """
+        target_host = ''
+        while not target_host:
+            target_host = raw_input('Target host: ')
+        user = ''
+        while not user:
+            user = raw_input('Target user: ')
+        password = ''
+        while not password:
+            password = raw_input('Target password: ')
+        filenames = []
+        while not filenames:
+            filenames = raw_input('Remote files: ').split()
+
+        target = FtpClient(debug=self._debug)
+        response = self._perform_client_command(target, 'connect',
+                                                target_host)
+        print response
+        if target.host is None:
+            return
+
+        response = self._perform_client_command(target, 'login', user,
+                                                password)
+        print response
+        if target.user is not None and self._ftp_client.block_mode:
+            response = self._perform_client_command(target, 'mode', True)
+            print response
+        if target.user is not None:
+            response = self._perform_ftp_command('copy_all_to', target,
+                                                 filenames)
+            print response
+
+        self._disconnect_helper_client(target)
+
+    def do_fanout(self, *args):
+        """
+        Command to send a local file to several FTP hosts at the same time,
+        reading it only once. Hosts are given separated by spaces and share
+        the same user and password.
+        """
+        local_filename = ''
+        while not local_filename:
+            local_filename = raw_input('Local file: ')
+        filename = ''
+        while not filename:
+            filename = raw_input('Remote file: ')
+        hosts = []
+        while not hosts:
+            hosts = raw_input('Target hosts: ').split()
+        user = ''
+        while not user:
+            user = raw_input('Target user: ')
+        password = ''
+        while not password:
+            password = raw_input('Target password: ')
+
+        targets = []
+        for host in hosts:
+            target = FtpClient(debug=self._debug)
+            response = self._perform_client_command(target, 'connect', host)
+            if target.host is not None:
+                response = self._perform_client_command(target, 'login',
+                                                        user, password)
+            if target.user is not None:
+                targets.append(target)
+            else:
+                print '{}: {}'.format(host, response)
+                if target.host is not None:
+                    self._disconnect_helper_client(target)
+
+        if targets:
+            start = time.time()
+            results = self._call_ftp_method(FtpClient.fan_out_store, 'store',
+                                            targets, local_filename, filename)
+            self._record_latency('fan_out_store', start)
+            if isinstance(results, list):
+                for result in results:
+                    status = 'OK' if result['succeeded'] else 'FAILED'
+                    print '{}: {} ({:.2f}s)\n{}'.format(
+                        result['host'], status, result['seconds'],
+                        result['message'])
+            else:
+                print results
+
+        for target in targets:
+            self._disconnect_helper_client(target)
+
     def do_pwd(self, *args):
         """
         Command to retrieve the current directory on the connected FTP host.
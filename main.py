@@ -1,5 +1,6 @@
 import sys
 import argparse
+import cProfile
 
 from interpreter import FtpInterpreter
 
@@ -9,10 +10,20 @@ def main():
     parser.add_argument('--debug', action='store_true',
                         help='Use this to see debug output from the '
                              'FTP client.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the session with cProfile and write '
+                             'the stats to FILE.')
     args = parser.parse_args(sys.argv[1:])
 
     ftps_interpreter = FtpInterpreter(debug=args.debug)
-    ftps_interpreter.cmdloop()
+    if args.profile:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(ftps_interpreter.cmdloop)
+        finally:
+            profiler.dump_stats(args.profile)
+    else:
+        ftps_interpreter.cmdloop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,291 @@
+import socket
+import struct
+import threading
+import unittest
+
+from client import FtpClient, _ChunkBuffer
+
+
+class BlockModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FtpClient()
+        self.client.host = 'localhost'
+        self.client.block_mode = True
+        self.client._data_connection, self.peer = socket.socketpair()
+        self.client._data_connection_open = True
+        self.client._command_socket, self.server = socket.socketpair()
+
+    def tearDown(self):
+        self.client._close_data_connection()
+        self.client._command_socket.close()
+        self.peer.close()
+        self.server.close()
+
+    def _write_blocks(self, content, eof=True):
+        received = []
+
+        def receive_all():
+            while True:
+                data = self.peer.recv(FtpClient.SOCKET_RCV_BYTES)
+                if not data:
+                    break
+                received.append(data)
+
+        reader = threading.Thread(target=receive_all)
+        reader.start()
+        self.client._write_blocks_to_data_connection(content, eof)
+        # Block mode keeps the connection open, signal the end explicitly.
+        self.client._data_connection.shutdown(socket.SHUT_WR)
+        reader.join()
+        return ''.join(received)
+
+    def test_write_blocks_splits_content_and_ends_with_eof(self):
+        content = 'x' * (FtpClient.BLOCK_MAX_BYTES + 10)
+
+        sent = self._write_blocks(content)
+        header = struct.unpack(FtpClient.BLOCK_HEADER_FORMAT, sent[:3])
+        self.assertEqual(header, (0, FtpClient.BLOCK_MAX_BYTES))
+        offset = 3 + FtpClient.BLOCK_MAX_BYTES
+        header = struct.unpack(FtpClient.BLOCK_HEADER_FORMAT,
+                               sent[offset:offset + 3])
+        self.assertEqual(header, (FtpClient.BLOCK_DESCRIPTOR_EOF, 10))
+        self.assertEqual(len(sent), offset + 3 + 10)
+
+    def test_write_blocks_without_eof_sends_nothing_for_empty_content(self):
+        self.assertEqual(self._write_blocks('', eof=False), '')
+
+    def test_write_empty_content_sends_eof_block(self):
+        self.assertEqual(self._write_blocks(''), struct.pack(
+            FtpClient.BLOCK_HEADER_FORMAT, FtpClient.BLOCK_DESCRIPTOR_EOF, 0))
+
+    def test_read_blocks_until_eof(self):
+        self.peer.sendall(
+            struct.pack(FtpClient.BLOCK_HEADER_FORMAT, 0, 3) + 'abc' +
+            struct.pack(FtpClient.BLOCK_HEADER_FORMAT,
+                        FtpClient.BLOCK_DESCRIPTOR_EOF, 2) + 'de')
+
+        self.assertEqual(self.client._read_from_data_connection(), 'abcde')
+        self.assertTrue(self.client._data_connection_open)
+
+    def test_read_blocks_records_restart_marker(self):
+        self.peer.sendall(
+            struct.pack(FtpClient.BLOCK_HEADER_FORMAT,
+                        FtpClient.BLOCK_DESCRIPTOR_RESTART_MARKER, 2) + '42' +
+            struct.pack(FtpClient.BLOCK_HEADER_FORMAT,
+                        FtpClient.BLOCK_DESCRIPTOR_EOF, 1) + 'a')
+
+        self.assertEqual(self.client._read_from_data_connection(), 'a')
+        self.assertEqual(self.client.restart_marker, '42')
+
+    def test_read_truncated_block_raises(self):
+        self.peer.sendall(struct.pack(FtpClient.BLOCK_HEADER_FORMAT,
+                                      FtpClient.BLOCK_DESCRIPTOR_EOF, 10) +
+                          'abc')
+        self.peer.close()
+        self.server.sendall('426 Transfer aborted.\r\n')
+
+        with self.assertRaises(FtpClient.DataConnectionClosedException) as cm:
+            self.client._read_from_data_connection()
+        self.assertIn('426', cm.exception.msg)
+        self.assertFalse(self.client._data_connection_open)
+
+    def test_read_closed_connection_without_eof_raises(self):
+        self.peer.close()
+        self.server.sendall('426 Transfer aborted.\r\n')
+
+        with self.assertRaises(FtpClient.DataConnectionClosedException):
+            self.client._read_from_data_connection()
+
+    def test_data_connection_alive_until_host_closes_it(self):
+        self.assertTrue(self.client._is_data_connection_alive())
+
+        self.peer.close()
+
+        self.assertFalse(self.client._is_data_connection_alive())
+
+    def test_open_data_connection_reuses_alive_connection(self):
+        self.assertEqual(self.client._open_data_connection(), '')
+        self.server.setblocking(False)
+        self.assertRaises(socket.error, self.server.recv, 1)
+
+
+
+class ScriptedFtpClient(FtpClient):
+    """
+    Client that records sent commands and answers with scripted replies.
+    """
+    def __init__(self, host, replies):
+        super(ScriptedFtpClient, self).__init__()
+        self.host = host
+        self.user = 'user'
+        self.commands = []
+        self.replies = list(replies)
+
+    def _send_command(self, command, *args):
+        self.commands.append(' '.join((command,) + args))
+
+    def _receive_command_data(self, *args):
+        return self.replies.pop(0)
+
+
+class CopyToTest(unittest.TestCase):
+
+    def test_copy_sequences_commands_on_both_hosts(self):
+        source = ScriptedFtpClient('source', [
+            '227 Entering Passive Mode (127,0,0,1,4,1).\r\n',
+            '150 Opening data connection.\r\n',
+            '226 Transfer complete.\r\n'])
+        target = ScriptedFtpClient('target', [
+            '200 PORT command successful.\r\n',
+            '150 Opening data connection.\r\n',
+            '226 Transfer complete.\r\n'])
+
+        data = source.copy_to(target, 'a.txt', 'b.txt')
+
+        self.assertEqual(source.commands, ['PASV', 'RETR a.txt'])
+        self.assertEqual(target.commands, ['PORT 127,0,0,1,4,1',
+                                           'STOR b.txt'])
+        self.assertTrue(data.endswith('226 Transfer complete.\r\n'))
+        self.assertEqual(source.replies, [])
+        self.assertEqual(target.replies, [])
+
+    def test_rejected_store_aborts_source(self):
+        source = ScriptedFtpClient('source', [
+            '227 Entering Passive Mode (127,0,0,1,4,1).\r\n',
+            '225 ABOR command successful.\r\n'])
+        target = ScriptedFtpClient('target', [
+            '200 PORT command successful.\r\n',
+            '553 Could not create file.\r\n'])
+
+        source.copy_to(target, 'a.txt')
+
+        self.assertEqual(source.commands, ['PASV', 'ABOR'])
+        self.assertEqual(source.replies, [])
+
+    def test_rejected_retrieve_aborts_target(self):
+        source = ScriptedFtpClient('source', [
+            '227 Entering Passive Mode (127,0,0,1,4,1).\r\n',
+            '550 No such file.\r\n'])
+        target = ScriptedFtpClient('target', [
+            '200 PORT command successful.\r\n',
+            '150 Opening data connection.\r\n',
+            '426 Connection closed; transfer aborted.\r\n',
+            '226 ABOR command successful.\r\n'])
+
+        source.copy_to(target, 'a.txt')
+
+        self.assertEqual(target.commands[-1], 'ABOR')
+        self.assertEqual(target.replies, [])
+
+    def test_copy_between_different_modes_raises(self):
+        source = ScriptedFtpClient('source', [])
+        target = ScriptedFtpClient('target', [])
+        source.block_mode = True
+
+        self.assertRaises(FtpClient.TransferModeMismatchException,
+                          source.copy_to, target, 'a.txt')
+        self.assertEqual(source.commands, [])
+
+
+
+class ChunkBufferTest(unittest.TestCase):
+
+    def _consume(self, chunks, consumer, received, errors):
+        try:
+            for chunk in chunks.chunks(consumer):
+                received.append(chunk)
+        except (FtpClient.LocalIOException,
+                FtpClient.LaggingHostException) as e:
+            errors.append(e)
+        finally:
+            chunks.remove_consumer(consumer)
+
+    def test_every_consumer_gets_every_chunk_and_chunks_are_freed(self):
+        chunks = _ChunkBuffer(2, 5)
+        consumers = [chunks.add_consumer(), chunks.add_consumer()]
+        received = [[], []]
+        threads = [threading.Thread(target=self._consume,
+                                    args=(chunks, consumer, received[i], []))
+                   for i, consumer in enumerate(consumers)]
+        for thread in threads:
+            thread.start()
+
+        for chunk in ('a', 'b', 'c', 'd', 'e'):
+            chunks.append(chunk)
+        chunks.close()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(received, [list('abcde'), list('abcde')])
+        self.assertEqual(len(chunks._chunks), 0)
+        self.assertFalse(chunks.has_consumers())
+
+    def test_append_waits_for_window_then_drops_lagging_consumer(self):
+        chunks = _ChunkBuffer(2, 0.05)
+        lagging = chunks.add_consumer()
+
+        chunks.append('a')
+        chunks.append('b')
+        chunks.append('c')
+
+        self.assertFalse(chunks.has_consumers())
+        self.assertEqual(len(chunks._chunks), 1)
+        self.assertRaises(FtpClient.LaggingHostException, list,
+                          chunks.chunks(lagging))
+
+    def test_error_is_raised_after_chunks_read_so_far(self):
+        chunks = _ChunkBuffer(4, 5)
+        consumers = [chunks.add_consumer(), chunks.add_consumer()]
+        chunks.append('a')
+        chunks.close('Input/output error')
+
+        for consumer in consumers:
+            received = []
+            errors = []
+            self._consume(chunks, consumer, received, errors)
+            self.assertEqual(received, ['a'])
+            self.assertEqual(len(errors), 1)
+            self.assertIn('Input/output error', errors[0].msg)
+
+
+class StoreChunksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client = ScriptedFtpClient('localhost', [
+            '150 Ok to send data.\r\n',
+            '426 Failure writing network stream.\r\n',
+            '226 ABOR successful.\r\n',
+            '250 Delete operation successful.\r\n'])
+        self.client._data_connection, self.peer = socket.socketpair()
+        self.client._data_connection_open = True
+        self.client._open_data_connection = lambda: ''
+
+    def tearDown(self):
+        self.peer.close()
+
+    def test_failed_read_aborts_and_deletes_partial_file(self):
+        def chunks():
+            yield 'a'
+            raise FtpClient.LocalIOException('Input/output error')
+
+        with self.assertRaises(FtpClient.LocalIOException) as cm:
+            self.client._store_chunks(chunks(), 'release.tar')
+
+        self.assertEqual(self.client.commands,
+                         ['STOR release.tar', 'ABOR', 'DELE release.tar'])
+        self.assertEqual(self.client.replies, [])
+        self.assertIn('426', cm.exception.msg)
+        self.assertFalse(self.client._data_connection_open)
+
+    def test_rejected_store_sends_nothing(self):
+        self.client.replies = ['553 Could not create file.\r\n']
+
+        data, succeeded = self.client._store_chunks(['a'], 'release.tar')
+
+        self.assertFalse(succeeded)
+        self.assertEqual(self.client.commands, ['STOR release.tar'])
+
+
+if __name__ == '__main__':
+    unittest.main()
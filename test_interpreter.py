@@ -0,0 +1,45 @@
+import unittest
+
+from interpreter import FtpInterpreter
+from test_client import ScriptedFtpClient
+
+
+class PercentileTest(unittest.TestCase):
+
+    def test_percentiles_of_sorted_values(self):
+        values = range(1, 101)
+
+        self.assertEqual(FtpInterpreter._percentile(values, 0), 1)
+        self.assertEqual(FtpInterpreter._percentile(values, 50), 51)
+        self.assertEqual(FtpInterpreter._percentile(values, 90), 90)
+        self.assertEqual(FtpInterpreter._percentile(values, 100), 100)
+
+    def test_percentile_of_single_value(self):
+        self.assertEqual(FtpInterpreter._percentile([0.5], 99), 0.5)
+
+
+class HelperClientStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interpreter = FtpInterpreter()
+
+    def test_main_client_commands_record_latency(self):
+        self.interpreter._perform_ftp_command('pwd')
+
+        self.assertEqual(len(self.interpreter._latencies['pwd']), 1)
+
+    def test_helper_client_is_not_timed_but_its_transfers_are_kept(self):
+        helper = ScriptedFtpClient('mirror', ['221 Goodbye.\r\n'])
+        helper.transfer_stats['bytes'] = 10
+        helper.transfer_stats['network_seconds'] = 0.5
+
+        self.interpreter._disconnect_helper_client(helper)
+
+        self.assertEqual(self.interpreter._latencies, {})
+        self.assertEqual(self.interpreter._helper_transfer_stats['bytes'], 10)
+        self.assertEqual(
+            self.interpreter._helper_transfer_stats['network_seconds'], 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()